@@ -1,7 +1,24 @@
 import os
 import json
+import asyncio
+import random
+import re
+import hashlib
+import shelve
+import tempfile
+import time
+import concurrent.futures
+import numpy as np
+import msgspec
 import pandas as pd
-from typing import Dict, Any
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+try:
+    # Optional: compiles the rolling statistics kernel; NumPy is used without it
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # Vertex AI and GenAI imports
 import vertexai
@@ -9,6 +26,7 @@ from vertexai.generative_models import GenerativeModel, Part
 from google.cloud import aiplatform
 import google.generativeai as genai
 from google.generativeai import types
+from google.api_core import exceptions as google_exceptions
 
 # ADK imports
 from agents import Agent
@@ -28,41 +46,528 @@ vertexai.init(project=PROJECT_ID, location=REGION)
 SYNTHESIS_MODEL_NAME = "gemini-2.5-pro"
 # Using Gemini 1.5 Flash for its speed and efficiency in targeted searches
 SEARCH_MODEL_NAME = "gemini-2.5-pro"
-SYNTHESIS_MODEL_OBJECT = GenerativeModel(SYNTHESIS_MODEL_NAME)
 
 # --- File Paths ---
 OUTPUT_DIR = "samples/YouTubeAgent/output"
 # The input CSV file provided by the user
 DATA_FILE = "samples/YouTubeAgent/music_engagement_data.csv"
-# Intermediate file to store detected anomalies
-ANOMALY_FILE = os.path.join(OUTPUT_DIR, "anomalies.json")
+# Intermediate file to store detected anomalies, one JSON record per line
+ANOMALY_FILE = os.path.join(OUTPUT_DIR, "anomalies.jsonl")
+# Columns read from the data file and their dtypes; repeated strings are stored as categoricals
+DATA_COLUMNS = ['date', 'track_id', 'track_name', 'artist_name', 'country', 'views', 'platform']
+DATA_DTYPES = {
+    'track_id': 'category',
+    'track_name': 'category',
+    'artist_name': 'category',
+    'country': 'category',
+    'platform': 'category',
+    # Nullable so that rows with a blank views cell can be dropped instead of failing the read
+    'views': 'Int32',
+}
+DATE_FORMAT = '%Y-%m-%d'
+# Parsed copy of the data file, reused while it is newer than the CSV. Bump the
+# schema version whenever DATA_DTYPES or _prepare_data change the parsed frame.
+PARQUET_CACHE_SCHEMA_VERSION = 1
+PARQUET_CACHE_FILE = f"{DATA_FILE}.v{PARQUET_CACHE_SCHEMA_VERSION}.parquet"
+# Data files larger than this are streamed in chunks of CSV_CHUNK_SIZE rows
+STREAM_THRESHOLD_BYTES = 512 * 1024 * 1024
+CSV_CHUNK_SIZE = 1_000_000
 # Final output file for the human-readable report
 FINAL_REPORT_FILE = os.path.join(OUTPUT_DIR, "final_analysis_report.md")
+# Persistent cache of search summaries, keyed by a hash of each anomaly's question
+SEARCH_CACHE_FILE = os.path.join(OUTPUT_DIR, "search_cache.db")
 
 # --- Analysis Parameters ---
 # Using a small window as the provided dataset spans only a few days
 MOVING_AVG_WINDOW = 2
 # A lower threshold to detect spikes in the short-term data
 STD_DEV_THRESHOLD = 2.0
+# Spikes are only reported for days with more views than this
+MIN_ANOMALY_VIEWS = 1000
+
+# --- Search Parameters ---
+# Maximum number of Google Search calls in flight at once
+SEARCH_CONCURRENCY = 10
+# Steady-state rate limit for Google Search calls, kept just under the provider quota
+SEARCH_REQUESTS_PER_MINUTE = 60
+# Number of anomalies researched together in a single search call
+SEARCH_BATCH_SIZE = 8
+# Retries (with exponential backoff) when the search model returns 429
+SEARCH_MAX_RETRIES = 5
+SEARCH_BACKOFF_BASE_SECONDS = 1.0
+# Set YOUTUBE_AGENT_NO_CACHE=1 to ignore cached search results and force fresh searches
+SEARCH_CACHE_DISABLED = os.environ.get("YOUTUBE_AGENT_NO_CACHE", "").lower() in ("1", "true", "yes")
+
+# --- Search Prompt ---
+# Static instructions come first and the per-anomaly questions last, so the
+# invariant prefix can be reused by provider-side prompt caching.
+SEARCH_HINT = "Look for social media trends, TikTok challenges, celebrity endorsements, or local events."
+SEARCH_BATCH_PREAMBLE = (
+    "Research each of the following engagement spikes and explain what caused each one.\n"
+    + SEARCH_HINT + "\n"
+    'Respond only with a JSON array containing one object per spike: [{"idx": 1, "summary": "..."}, ...]\n'
+    "\n"
+)
+# Fenced ```json block the model usually wraps its array in
+JSON_FENCE_PATTERN = re.compile(r"```json\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+# Each anomaly's question is also its key in the search cache
+SEARCH_QUESTION_TEMPLATE = 'What caused a spike in interest for the song "{track_name}" by "{artist_name}" in {country} around {date}?'
+SEARCH_ERROR_SUMMARY = "Error: Could not perform search for this anomaly."
+
+# --- Report Prompt ---
+# The static parts of the synthesis prompt are sent as the system instruction and
+# the anomaly data last, so the invariant prefix can be reused by implicit prompt caching.
+ANALYST_SYSTEM_PROMPT = """
+You are a senior music industry analyst. Your task is to write an insightful report
+explaining significant engagement spikes for an artist's tracks on YouTube Shorts.
+
+You will be provided with a list of statistical anomalies and a corresponding
+AI-generated research summary for each one. Your job is to synthesize this information
+into a clear, concise, and actionable report.
+"""
+
+REPORT_INSTRUCTIONS = """
+**Report Generation Instructions:**
+1.  **Main Title:** Start with a clear headline, like "Analysis of Engagement Anomalies for Synthwave Surfer".
+2.  **Executive Summary:** Write a brief paragraph summarizing the key findings. What were the main drivers of engagement spikes?
+3.  **Detailed Anomaly Analysis:** For each anomaly, create a separate section with a subheading (e.g., "Spike for 'Neon Rider' in USA on 2025-07-04").
+    *   **State the Anomaly:** Clearly describe the event (e.g., "The track 'Neon Rider' experienced a significant viewership spike in the USA, reaching X views against a recent average of Y.").
+    *   **Synthesize the Cause:** Review the provided 'research_summary'. Do not just copy it. Interpret the information and state the most plausible cause. For instance, "Our research strongly suggests this spike was driven by the song's use in 4th of July celebration videos trending on social media." or "The spike correlates with a new dance challenge that emerged on TikTok in Germany."
+    *   **Confidence Score:** Assign a confidence level (High, Medium, Low) to your conclusion and briefly explain why.
+4.  **Overall Conclusion & Recommendations:** Conclude the report with a summary of patterns and potential recommendations for the artist or marketing team.
+
+Format the output in Markdown for clarity and readability.
+"""
+
+SYNTHESIS_MODEL_OBJECT = GenerativeModel(SYNTHESIS_MODEL_NAME, system_instruction=[ANALYST_SYSTEM_PROMPT, REPORT_INSTRUCTIONS])
 
 # Ensure the output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
+# --- Data Models ---
+class Anomaly(msgspec.Struct):
+    """A detected engagement spike, as saved to ANOMALY_FILE."""
+    date: str
+    track_id: str
+    track_name: str
+    artist_name: str
+    country: str
+    views: int
+    local_average: float
+    platform: str
+
+
+class ResearchedAnomaly(Anomaly):
+    """An anomaly together with the search findings about its cause."""
+    research_summary: str
+
+
+class SearchSummary(msgspec.Struct):
+    """One entry of the JSON array returned by a batched search."""
+    idx: int
+    summary: str
+
+
+# DataFrame columns used to build each Anomaly, in field order
+ANOMALY_COLUMNS = list(Anomaly.__struct_fields__)
+
+
 # --- Google Search Function ---
-def google_search(query: str) -> str:
+# In-process layer in front of the on-disk search cache
+_search_memory_cache: Dict[str, str] = {}
+
+
+def _search_cache_key(query: str) -> str:
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+def _read_search_cache(keys: List[str]) -> List[Optional[str]]:
     """
-    Performs a Google search using the specified model and returns the result.
+    Returns the cached search result for each of `keys`, or None on a miss.
+    The shelf is opened at most once, and only for keys not already in memory.
     """
-    print(f"Executing Google Search with query: '{query}'")
+    if SEARCH_CACHE_DISABLED:
+        return [None] * len(keys)
+    missing = [key for key in keys if key not in _search_memory_cache]
+    if missing:
+        try:
+            with shelve.open(SEARCH_CACHE_FILE) as shelf:
+                for key in missing:
+                    result = shelf.get(key)
+                    if result is not None:
+                        _search_memory_cache[key] = result
+        except Exception as e:
+            print(f"Could not read search cache: {e}")
+    return [_search_memory_cache.get(key) for key in keys]
+
+
+def _write_search_cache(results: Dict[str, str]) -> None:
+    """Caches every key -> result pair in `results`, opening the shelf once."""
+    _search_memory_cache.update(results)
+    if not results:
+        return
     try:
-        # Using the google.generativeai library for the search tool
-        model = genai.GenerativeModel('gemini-1.5-flash-001', tools=[types.Tool.from_google_search_retrieval(types.GoogleSearchRetrieval())])
-        response = model.generate_content(query, tool_config={'google_search_retrieval': {'max_references_per_query': 5}})
-        return response.text.strip()
+        with shelve.open(SEARCH_CACHE_FILE) as shelf:
+            for key, result in results.items():
+                shelf[key] = result
     except Exception as e:
-        print(f"An error occurred during Google Search: {e}")
-        return f"Error: Could not perform search for query '{query}'."
+        print(f"Could not write search cache: {e}")
+
+
+class TokenBucket:
+    """
+    Async token-bucket rate limiter. Tokens refill continuously at
+    `requests_per_minute` up to `capacity`; `acquire` waits until a token is
+    available. Waiters are served in arrival order.
+    """
+
+    def __init__(self, requests_per_minute: float, capacity: float = 1.0):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+async def google_search_async(query: str, sem: asyncio.Semaphore, bucket: TokenBucket) -> Optional[str]:
+    """
+    Performs a Google search using the specified model and returns the result,
+    or None if the search fails. Concurrency is bounded by `sem` and request
+    rate by `bucket`; rate-limit (429) errors are retried with exponential backoff.
+    """
+    async with sem:
+        print(f"Executing Google Search with query: '{query}'")
+        try:
+            # Using the google.generativeai library for the search tool
+            model = genai.GenerativeModel('gemini-1.5-flash-001', tools=[types.Tool.from_google_search_retrieval(types.GoogleSearchRetrieval())])
+            for attempt in range(SEARCH_MAX_RETRIES + 1):
+                try:
+                    await bucket.acquire()
+                    response = await model.generate_content_async(query, tool_config={'google_search_retrieval': {'max_references_per_query': 5}})
+                    return response.text.strip()
+                except google_exceptions.ResourceExhausted:
+                    if attempt == SEARCH_MAX_RETRIES:
+                        raise
+                    delay = SEARCH_BACKOFF_BASE_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+                    print(f"Search rate limited, retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+        except Exception as e:
+            print(f"An error occurred during Google Search: {e}")
+            return None
+
+
+def _search_question(anomaly: Anomaly) -> str:
+    return SEARCH_QUESTION_TEMPLATE.format_map(msgspec.structs.asdict(anomaly))
+
+
+def _build_batch_query(questions: List[str]) -> str:
+    """Builds a single search prompt that asks every question in `questions`."""
+    return SEARCH_BATCH_PREAMBLE + "\n".join(f"{idx}. {question}" for idx, question in enumerate(questions, start=1))
+
+
+def _parse_batch_response(text: str, count: int) -> Dict[int, str]:
+    """
+    Extracts the JSON array of {idx, summary} objects from a batched search
+    response. Search grounding cannot be combined with JSON mode, so the array
+    may be wrapped in prose or a code fence. A fenced json block is used if
+    present; otherwise each '[' is tried in turn, so bracketed citations such as
+    "[1]" around the array are skipped.
+    """
+    fenced = JSON_FENCE_PATTERN.search(text)
+    candidates = [fenced.group(1), text] if fenced else [text]
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        start = candidate.find('[')
+        while start != -1:
+            try:
+                _, end = decoder.raw_decode(candidate, start)
+                items = msgspec.json.decode(candidate[start:end], type=List[SearchSummary])
+            except (ValueError, msgspec.DecodeError):
+                items = None
+            if items:
+                return {item.idx: item.summary.strip() for item in items if 1 <= item.idx <= count and item.summary.strip()}
+            start = candidate.find('[', start + 1)
+    raise ValueError("no JSON array of summaries in response")
+
+
+async def _research_batch(questions: List[str], sem: asyncio.Semaphore, bucket: TokenBucket) -> List[Optional[str]]:
+    """
+    Researches `questions` with one batched search call. Any question the batched
+    response does not answer is searched on its own. Returns a summary per
+    question, or None where the search failed.
+    """
+    summaries: Dict[int, Optional[str]] = {}
+    if len(questions) > 1:
+        result = await google_search_async(_build_batch_query(questions), sem, bucket)
+        if result is not None:
+            try:
+                summaries.update(_parse_batch_response(result, len(questions)))
+            except (ValueError, msgspec.DecodeError) as e:
+                print(f"Could not parse batched search response, searching individually: {e}")
+
+    missing = [idx for idx in range(1, len(questions) + 1) if idx not in summaries]
+    results = await asyncio.gather(*(google_search_async(f"{questions[idx - 1]} {SEARCH_HINT}", sem, bucket) for idx in missing))
+    summaries.update(zip(missing, results))
+    return [summaries[idx] for idx in range(1, len(questions) + 1)]
+
+
+async def _research_all(anomalies: List[Anomaly]) -> List[str]:
+    """
+    Researches all anomalies and returns summaries in anomaly order. Each anomaly
+    is looked up in the search cache first; only the misses are searched, in
+    concurrent batches of SEARCH_BATCH_SIZE, and each new summary is cached
+    under its own question. The on-disk cache is opened once to read and once
+    to write.
+    """
+    sem = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    bucket = TokenBucket(SEARCH_REQUESTS_PER_MINUTE)
+    questions = [_search_question(anomaly) for anomaly in anomalies]
+    keys = [_search_cache_key(question) for question in questions]
+    summaries = _read_search_cache(keys)
+    misses = [i for i, summary in enumerate(summaries) if summary is None]
+    print(f"{len(questions) - len(misses)} of {len(questions)} anomalies answered from the search cache")
+
+    batches = [misses[i:i + SEARCH_BATCH_SIZE] for i in range(0, len(misses), SEARCH_BATCH_SIZE)]
+    results = await asyncio.gather(*(_research_batch([questions[i] for i in batch], sem, bucket) for batch in batches),
+                                   return_exceptions=True)
+    new_results: Dict[str, str] = {}
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            result = [None] * len(batch)
+        for i, summary in zip(batch, result):
+            if summary is None:
+                summaries[i] = SEARCH_ERROR_SUMMARY
+            else:
+                new_results[keys[i]] = summary
+                summaries[i] = summary
+    _write_search_cache(new_results)
+    return summaries
+
+
+def _run_async(coro):
+    """
+    Runs `coro` to completion from synchronous code. If this thread already has a
+    running event loop (e.g. inside the agent runtime), the coroutine runs on a
+    fresh loop in a worker thread instead, since asyncio.run cannot nest.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+# --- Anomaly Detection ---
+def _prepare_data(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the 'date' column with a fixed format. errors='coerce' turns any
+    unparseable dates into NaT (Not a Time). Rows without a date or a views count
+    are dropped. Dates are stored at second resolution and views in the smallest
+    unsigned integer type that fits, to keep the arrays used for detection compact.
+    """
+    df['date'] = pd.to_datetime(df['date'], format=DATE_FORMAT, errors='coerce')
+    df = df.dropna(subset=['date', 'views'])
+    return df.assign(
+        date=df['date'].astype('datetime64[s]'),
+        views=pd.to_numeric(df['views'].to_numpy(dtype=np.int32), downcast='unsigned'),
+    )
+
+
+def _load_engagement_data() -> pd.DataFrame:
+    """
+    Loads the data file with dates parsed. The parsed frame is saved as Parquet
+    next to the CSV and reused on later runs while it is newer than the CSV.
+    """
+    if os.path.exists(PARQUET_CACHE_FILE) and os.path.getmtime(PARQUET_CACHE_FILE) >= os.path.getmtime(DATA_FILE):
+        try:
+            return pd.read_parquet(PARQUET_CACHE_FILE, columns=DATA_COLUMNS)
+        except Exception as e:
+            # A truncated cache or missing Parquet engine falls back to the CSV, which rewrites the cache
+            print(f"Could not read Parquet cache, re-parsing the CSV: {e}")
+
+    df = pd.read_csv(DATA_FILE, usecols=DATA_COLUMNS, dtype=DATA_DTYPES, on_bad_lines='skip', engine='c')
+    df = _prepare_data(df)
+    try:
+        df.to_parquet(PARQUET_CACHE_FILE, compression='zstd')
+    except Exception as e:
+        # Parquet support (pyarrow) is optional; the CSV is simply re-parsed next time
+        print(f"Could not cache parsed data as Parquet: {e}")
+    return df
+
+
+def _rolling_stats_numpy(views: np.ndarray, group_starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the moving average and upper band of the PREVIOUS MOVING_AVG_WINDOW
+    views for every row. `views` must be contiguous per group and in date order,
+    with each group beginning at an index in `group_starts`; it may keep its
+    narrow integer dtype, the statistics are computed in float64. Rows fewer
+    than MOVING_AVG_WINDOW positions into their group get NaN.
+    """
+    n = len(views)
+    # Row i's window is views[i - W:i], which is only valid once the row is at
+    # least W positions into its group
+    group_sizes = np.diff(np.append(group_starts, n))
+    position_in_group = np.arange(n) - np.repeat(group_starts, group_sizes)
+    moving_avg = np.full(n, np.nan)
+    moving_std = np.zeros(n)
+    if n > MOVING_AVG_WINDOW:
+        if MOVING_AVG_WINDOW == 2:
+            # Closed form for the default window: mean and sample std of two values.
+            # Summing in float64 avoids overflow and unsigned wrap-around.
+            previous, latest = views[:-2], views[1:-1]
+            moving_avg[2:] = 0.5 * np.add(previous, latest, dtype=np.float64)
+            moving_std[2:] = np.abs(np.subtract(previous, latest, dtype=np.float64)) / np.sqrt(2.0)
+        else:
+            windows = sliding_window_view(views, MOVING_AVG_WINDOW)[:-1]
+            moving_avg[MOVING_AVG_WINDOW:] = windows.mean(axis=1)
+            if MOVING_AVG_WINDOW > 1:
+                moving_std[MOVING_AVG_WINDOW:] = windows.std(axis=1, ddof=1)
+    moving_avg[position_in_group < MOVING_AVG_WINDOW] = np.nan
+    return moving_avg, moving_avg + (moving_std * STD_DEV_THRESHOLD)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _rolling_stats_kernel(views, group_bounds, window, threshold):
+        """
+        Compiled equivalent of `_rolling_stats_numpy`. Groups are the runs
+        views[group_bounds[g]:group_bounds[g + 1]] and are processed in parallel;
+        the window sum is kept as a float accumulator within each group, so
+        `views` can stay in its downcast integer dtype.
+        """
+        n = views.shape[0]
+        moving_avg = np.full(n, np.nan)
+        upper_band = np.full(n, np.nan)
+        for g in prange(group_bounds.shape[0] - 1):
+            start, end = group_bounds[g], group_bounds[g + 1]
+            window_sum = 0.0
+            for i in range(start, end):
+                if i - start >= window:
+                    mean = window_sum / window
+                    std = 0.0
+                    if window > 1:
+                        sq_dev = 0.0
+                        for j in range(i - window, i):
+                            sq_dev += (views[j] - mean) ** 2
+                        std = np.sqrt(sq_dev / (window - 1))
+                    moving_avg[i] = mean
+                    upper_band[i] = mean + threshold * std
+                    window_sum -= views[i - window]
+                window_sum += views[i]
+        return moving_avg, upper_band
+
+
+def _detect_anomalies(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Flags days where a track's views in a country exceed the moving average of
+    the PREVIOUS days by more than STD_DEV_THRESHOLD standard deviations.
+    Rolling statistics for all (track, country) groups are computed in one pass
+    over the views, ordered by group and date, with the compiled Numba kernel
+    when available and NumPy otherwise.
+    Returns the anomalous rows with an added 'moving_avg' column.
+    """
+    # Codes come from a hash groupby (sort=False) on the categorical keys; the
+    # groups only need to be contiguous, not in key order
+    group_codes = df.groupby(['track_id', 'country'], sort=False, observed=True).ngroup().to_numpy()
+
+    # Skip groups that never exceed MIN_ANOMALY_VIEWS. This is exact: a row can
+    # only be flagged if its own views exceed that floor.
+    group_max = df['views'].groupby(group_codes).transform('max').to_numpy()
+    rows = np.flatnonzero(group_max > MIN_ANOMALY_VIEWS)
+
+    # Sort row positions (not the frame itself) by group, then date, so each group's
+    # views are a contiguous run in a single array. The views keep the narrow
+    # dtype from _prepare_data; both kernels accumulate in float64.
+    order = rows[np.lexsort((df['date'].to_numpy()[rows], group_codes[rows]))]
+    views = df['views'].to_numpy()[order]
+    n = len(views)
+
+    group_starts = np.concatenate(([0], np.flatnonzero(np.diff(group_codes[order])) + 1))
+    if njit is not None:
+        moving_avg, upper_band = _rolling_stats_kernel(views, np.append(group_starts, n),
+                                                       MOVING_AVG_WINDOW, STD_DEV_THRESHOLD)
+    else:
+        moving_avg, upper_band = _rolling_stats_numpy(views, group_starts)
+
+    # Rows without a full window have a NaN average and never compare as anomalies
+    mask = (views > upper_band) & (views > MIN_ANOMALY_VIEWS)
+    return df.iloc[order[mask]].assign(moving_avg=moving_avg[mask])
+
+
+def _check_chunk_order(carried: pd.DataFrame, chunk: pd.DataFrame) -> None:
+    """Raises ValueError if any group in `chunk` has a date before that group's carried rows."""
+    group_keys = ['track_id', 'country']
+    last_seen = carried.groupby(group_keys, sort=False, observed=True)['date'].max()
+    first_new = chunk.groupby(group_keys, sort=False, observed=True)['date'].min()
+    first_new, last_seen = first_new.align(last_seen, join='inner')
+    out_of_order = first_new[first_new < last_seen]
+    if not out_of_order.empty:
+        (track_id, country), date = next(iter(out_of_order.items()))
+        raise ValueError(
+            f"Data file is not in chronological order: {len(out_of_order)} track/country group(s) go back in time "
+            f"between chunks (e.g. track {track_id} in {country} on {date:{DATE_FORMAT}}). "
+            f"Sort the file by date before analysing files larger than {STREAM_THRESHOLD_BYTES} bytes."
+        )
+
+
+def _detect_anomalies_stream() -> Iterator[pd.DataFrame]:
+    """
+    Streams the data file in chunks of CSV_CHUNK_SIZE rows and yields the
+    anomalies found in each chunk. The last MOVING_AVG_WINDOW rows of every
+    (track, country) group are carried over to the next chunk so rolling
+    statistics continue across chunk boundaries. Rows for a given track and
+    country must appear in chronological order across chunks; a ValueError is
+    raised if a chunk goes back in time for any group, since earlier rows can
+    no longer be placed correctly.
+    """
+    carried = None
+    reader = pd.read_csv(DATA_FILE, usecols=DATA_COLUMNS, dtype=DATA_DTYPES, on_bad_lines='skip',
+                         engine='c', chunksize=CSV_CHUNK_SIZE)
+    for chunk in reader:
+        chunk = _prepare_data(chunk)
+        if carried is not None:
+            _check_chunk_order(carried, chunk)
+        combined = chunk if carried is None else pd.concat([carried, chunk])
+        anomalies_df = _detect_anomalies(combined)
+        # Carried rows were already checked with the previous chunk
+        yield anomalies_df[anomalies_df.index.isin(chunk.index)]
+
+        # tail() keeps row order within each group, so only a stable date sort is needed
+        carried = (combined.sort_values(by='date', kind='stable')
+                   .groupby(['track_id', 'country'], sort=False, observed=True)
+                   .tail(MOVING_AVG_WINDOW))
+
+
+def _anomaly_records(anomalies_df: pd.DataFrame) -> List[Anomaly]:
+    """Converts detected anomaly rows into Anomaly records."""
+    # Blank text cells are read as missing; write them as empty strings so the
+    # records still decode as Anomaly
+    text_columns = [column for column, dtype in DATA_DTYPES.items() if dtype == 'category']
+    # Daily data repeats the same few dates, so each distinct date is formatted once
+    date_codes, unique_dates = pd.factorize(anomalies_df['date'])
+    anomalies_df = anomalies_df.assign(
+        **{column: anomalies_df[column].astype(object).fillna('') for column in text_columns},
+        date=unique_dates.strftime(DATE_FORMAT).to_numpy()[date_codes],
+        views=anomalies_df['views'].astype('int64'),
+        local_average=anomalies_df['moving_avg'].round(2),
+    )
+    columns = [anomalies_df[column].tolist() for column in ANOMALY_COLUMNS]
+    return [Anomaly(*values) for values in zip(*columns)]
 
 
 # --- Tool Functions for Agents ---
@@ -74,71 +579,44 @@ def data_ingestion_and_anomaly_detection_tool(tool_context: ToolContext) -> Dict
     in view counts for each track in each country, and saves them to a file.
     """
     print("\n--- Executing Data Ingestion and Anomaly Detection Tool ---")
-    all_anomalies = []
+    anomalies_found = 0
+    temp_file = None
     try:
-        # --- ROBUSTNESS FIX ---
-        # Read the CSV first, then attempt to convert dates.
-        # errors='coerce' will turn any unparseable dates into NaT (Not a Time).
-        df = pd.read_csv(DATA_FILE)
-        df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        # Drop any rows where the date could not be parsed.
-        df.dropna(subset=['date'], inplace=True)
-        # --- END FIX ---
-
-        df.sort_values(by=['track_id', 'country', 'date'], inplace=True)
-
-        # Group data by each unique track in each country
-        grouped = df.groupby(['track_id', 'track_name', 'artist_name', 'country'])
-
-        for name, group in grouped:
-            track_name, country = name[1], name[3]
-            print(f"Analyzing: Track '{track_name}' in {country}")
-
-            if len(group) < MOVING_AVG_WINDOW:
-                continue
-
-            # Calculate rolling statistics on PREVIOUS days' data using .shift(1)
-            group = group.copy()
-            shifted_views = group['views'].shift(1)
-            group['moving_avg'] = shifted_views.rolling(window=MOVING_AVG_WINDOW).mean()
-            group['moving_std'] = shifted_views.rolling(window=MOVING_AVG_WINDOW).std().fillna(0)
-            group['upper_band'] = group['moving_avg'] + (group['moving_std'] * STD_DEV_THRESHOLD)
-
-            # Drop initial rows where rolling metrics can't be calculated
-            group.dropna(subset=['moving_avg'], inplace=True)
-
-            # Identify anomalies where views are significantly higher than the average
-            anomalies_df = group[(group['views'] > group['upper_band']) & (group['views'] > 1000)]
-
-            for index, row in anomalies_df.iterrows():
-                anomaly_data = {
-                    "date": row['date'].strftime('%Y-%m-%d'),
-                    "track_id": row['track_id'],
-                    "track_name": row['track_name'],
-                    "artist_name": row['artist_name'],
-                    "country": row['country'],
-                    "views": int(row['views']),
-                    "local_average": round(row['moving_avg'], 2),
-                    "platform": row['platform']
-                }
-                all_anomalies.append(anomaly_data)
-                print(f"  > Anomaly Detected! On {anomaly_data['date']}, views spiked to {anomaly_data['views']:,} (Avg: {anomaly_data['local_average']:,})")
+        # Very large files are read in chunks so memory stays bounded
+        if os.path.getsize(DATA_FILE) > STREAM_THRESHOLD_BYTES:
+            anomaly_frames = _detect_anomalies_stream()
+        else:
+            anomaly_frames = [_detect_anomalies(_load_engagement_data())]
+
+        # Save each anomaly as soon as it is detected, to a temporary file that only
+        # replaces ANOMALY_FILE once detection has finished, so a failed run never
+        # leaves partial results for the reporting tool
+        encoder = msgspec.json.Encoder()
+        with tempfile.NamedTemporaryFile('wb', dir=OUTPUT_DIR, suffix='.tmp', delete=False) as f:
+            temp_file = f.name
+            for anomalies_df in anomaly_frames:
+                anomalies = _anomaly_records(anomalies_df)
+                f.write(encoder.encode_lines(anomalies))
+                anomalies_found += len(anomalies)
+                for anomaly in anomalies:
+                    print(f"  > Anomaly Detected! On {anomaly.date}, views spiked to {anomaly.views:,} (Avg: {anomaly.local_average:,})")
+        os.replace(temp_file, ANOMALY_FILE)
 
     except FileNotFoundError:
         return {"status": "error", "message": f"Data file not found: {DATA_FILE}"}
     except Exception as e:
         return {"status": "error", "message": f"An error occurred during analysis: {e}"}
+    finally:
+        # Only still present if detection failed before the replace
+        if temp_file is not None and os.path.exists(temp_file):
+            os.remove(temp_file)
 
-    if not all_anomalies:
+    if not anomalies_found:
         print("No significant anomalies found.")
         return {"status": "success", "message": "No significant anomalies found."}
 
-    # Save the detected anomalies to the JSON file
-    with open(ANOMALY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(all_anomalies, f, indent=4)
-
-    print(f"\nSuccessfully saved {len(all_anomalies)} anomalies to {ANOMALY_FILE}")
-    return {"status": "success", "anomalies_found": len(all_anomalies), "output_file": ANOMALY_FILE}
+    print(f"\nSuccessfully saved {anomalies_found} anomalies to {ANOMALY_FILE}")
+    return {"status": "success", "anomalies_found": anomalies_found, "output_file": ANOMALY_FILE}
 
 def hypothesis_evidence_and_reporting_tool(tool_context: ToolContext) -> Dict[str, Any]:
     """
@@ -148,50 +626,31 @@ def hypothesis_evidence_and_reporting_tool(tool_context: ToolContext) -> Dict[st
     """
     print("\n--- Executing Hypothesis, Evidence, and Reporting Tool ---")
     try:
-        with open(ANOMALY_FILE, 'r', encoding='utf-8') as f:
-            anomalies = json.load(f)
+        with open(ANOMALY_FILE, 'rb') as f:
+            anomalies = msgspec.json.Decoder(Anomaly).decode_lines(f.read())
     except FileNotFoundError:
         return {"status": "error", "message": f"Anomaly file not found: {ANOMALY_FILE}. Run the detection tool first."}
+    except msgspec.DecodeError as e:
+        # Also covers msgspec.ValidationError, e.g. a record written by an older version
+        return {"status": "error", "message": f"Could not read anomalies from {ANOMALY_FILE}: {e}. Re-run the detection tool."}
 
-    researched_anomalies = []
+    # Generate targeted search queries and gather evidence for all anomalies (Hypothesis Generation)
     for anomaly in anomalies:
-        # Generate a targeted search query to find context (Hypothesis Generation)
-        query = (f"What caused a spike in interest for the song \"{anomaly['track_name']}\" by "
-                 f"\"{anomaly['artist_name']}\" in {anomaly['country']} around {anomaly['date']}? "
-                 f"Look for social media trends, TikTok challenges, celebrity endorsements, or local events.")
+        print(f"Investigating anomaly for '{anomaly.track_name}' in {anomaly.country}...")
+    search_summaries = _run_async(_research_all(anomalies))
 
-        # Gather evidence for the hypothesis
-        print(f"Investigating anomaly for '{anomaly['track_name']}' in {anomaly['country']}...")
-        search_summary = google_search(query)
-
-        anomaly_with_research = anomaly.copy()
-        anomaly_with_research["research_summary"] = search_summary
-        researched_anomalies.append(anomaly_with_research)
+    researched_anomalies = [
+        ResearchedAnomaly(**msgspec.structs.asdict(anomaly), research_summary=search_summary)
+        for anomaly, search_summary in zip(anomalies, search_summaries)
+    ]
 
     # Synthesize the final report (Reporting Agent)
+    # The analyst role and instructions are the model's system instruction; only the data is sent here.
     prompt = f"""
-    You are a senior music industry analyst. Your task is to write an insightful report
-    explaining significant engagement spikes for an artist's tracks on YouTube Shorts.
-
-    You have been provided with a list of statistical anomalies and a corresponding
-    AI-generated research summary for each one. Your job is to synthesize this information
-    into a clear, concise, and actionable report.
-
     **Data (Anomalies and Research Summaries):**
     ---
-    {json.dumps(researched_anomalies, indent=2)}
+    {msgspec.json.format(msgspec.json.encode(researched_anomalies), indent=2).decode()}
     ---
-
-    **Report Generation Instructions:**
-    1.  **Main Title:** Start with a clear headline, like "Analysis of Engagement Anomalies for Synthwave Surfer".
-    2.  **Executive Summary:** Write a brief paragraph summarizing the key findings. What were the main drivers of engagement spikes?
-    3.  **Detailed Anomaly Analysis:** For each anomaly, create a separate section with a subheading (e.g., "Spike for 'Neon Rider' in USA on 2025-07-04").
-        *   **State the Anomaly:** Clearly describe the event (e.g., "The track 'Neon Rider' experienced a significant viewership spike in the USA, reaching X views against a recent average of Y.").
-        *   **Synthesize the Cause:** Review the provided 'research_summary'. Do not just copy it. Interpret the information and state the most plausible cause. For instance, "Our research strongly suggests this spike was driven by the song's use in 4th of July celebration videos trending on social media." or "The spike correlates with a new dance challenge that emerged on TikTok in Germany."
-        *   **Confidence Score:** Assign a confidence level (High, Medium, Low) to your conclusion and briefly explain why.
-    4.  **Overall Conclusion & Recommendations:** Conclude the report with a summary of patterns and potential recommendations for the artist or marketing team.
-
-    Format the output in Markdown for clarity and readability.
     """
 
     print("Generating final report with Gemini 1.5 Pro...")